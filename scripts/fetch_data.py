@@ -1,8 +1,17 @@
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import hashlib
 import os
-import statistics
+import time
+from bisect import bisect_left
+from heapq import merge
+from itertools import zip_longest
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 
 # Hardcoded measure IDs (these don't change)
 MEASURE_IDS = {
@@ -24,188 +33,399 @@ RAINFALL_STATIONS = [
     '249744TP-rainfall-tipping_bucket_raingauge-t-15_min-mm',  # Swindon
 ]
 
-def fetch_all_readings_for_period(measure_id, since_timestamp):
-    '''Fetch all readings for a measure since a given timestamp'''
+READINGS_URL = "https://environment.data.gov.uk/flood-monitoring/id/measures/{measure_id}/readings.json"
+OURCS_FLAG_URL = "https://ourcs.co.uk/api/flags/status/{reach}/"
+ENSEMBLE_URL = "https://ensemble-api.open-meteo.com/v1/ensemble"
+
+# Oxford coordinates, for the weather forecasts
+OXFORD_LAT, OXFORD_LON = 51.7520, -1.2577
+
+# Flow trend labels indexed by the sign of the 2-hour flow change (past a 0.1m threshold)
+FLOW_TRENDS = ('Falling', 'Stable', 'Rising')
+
+# One pooled session for every request, so connections (and TLS sessions) are reused
+# across calls to the same host. Sized for the concurrent fetches in main().
+# Transient 5xx and connection failures are retried with backoff; a read timeout is
+# retried only once, since a server that stalled once will usually stall again.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, read=1, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+))
+
+# Seconds to wait for a connection. Kept short so an unreachable host fails fast,
+# separately from the (longer) per-request read timeouts.
+CONNECT_TIMEOUT = 10
+# The readings payloads are verbose JSON and compress ~10x; always ask for it
+SESSION.headers['Accept-Encoding'] = 'gzip, deflate'
+
+# Validators (ETag/Last-Modified) from the previous run, keyed by URL, with a digest of
+# the body each one validates; the parsed bodies are kept beside them keyed by that digest.
+# Neither file is committed: the workflow carries them between runs in the Actions cache,
+# and a request whose body is missing (e.g. on a cache miss) is just made unconditionally.
+# Only entries used during this run are written back, so stale URLs age out.
+HTTP_CACHE_FILE = 'data/http_cache.json'
+HTTP_BODIES_FILE = 'data/http_bodies.json'
+previous_http_cache = {}
+previous_http_bodies = {}
+http_cache = {}
+http_bodies = {}
+
+def write_atomic(path, content):
+    '''Write bytes to path via a temporary file, so a crash mid-write never leaves it truncated'''
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def load_http_cache():
+    '''Load the conditional-GET validators and bodies written by the previous run'''
+    for path, cache in ((HTTP_CACHE_FILE, previous_http_cache), (HTTP_BODIES_FILE, previous_http_bodies)):
+        try:
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    cache.update(orjson.loads(f.read()))
+        except Exception as e:
+            print(f"Could not load HTTP cache {path}: {e}")
+
+def save_http_cache():
+    '''Persist validators and bodies for the responses seen during this run, if they changed'''
+    for path, previous, current in ((HTTP_CACHE_FILE, previous_http_cache, http_cache), (HTTP_BODIES_FILE, previous_http_bodies, http_bodies)):
+        # Sorted, so the bytes don't depend on the order the worker threads finished in
+        content = orjson.dumps(current, option=orjson.OPT_SORT_KEYS)
+        if content != orjson.dumps(previous, option=orjson.OPT_SORT_KEYS):
+            write_atomic(path, content)
+
+def cache_lifetime(headers):
+    '''Seconds a response may be reused without revalidating, from its Cache-Control max-age'''
+    directives = [d.strip().lower() for d in headers.get('Cache-Control', '').split(',')]
+    if 'no-cache' in directives or 'no-store' in directives:
+        return 0
+    for directive in directives:
+        if directive.startswith('max-age='):
+            try:
+                return int(directive[len('max-age='):])
+            except ValueError:
+                return 0
+    return 0
+
+def is_fresh(entry):
+    '''Whether a cached response is still within its max-age, counted from its Date header'''
+    if not entry.get('date') or not entry.get('max_age'):
+        return False
     try:
-        readings_url = f"https://environment.data.gov.uk/flood-monitoring/id/measures/{measure_id}/readings.json"
-        params = {'since': since_timestamp, '_limit': 10000, '_sorted': ''}
+        served = parsedate_to_datetime(entry['date']).timestamp()
+    except (TypeError, ValueError):
+        return False
+    return served + entry['max_age'] > time.time()
+
+def cache_entry(headers, body_sha):
+    '''Cache entry for a response: its validators and freshness, all taken from the response headers'''
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'date': headers.get('Date'),
+        'max_age': cache_lifetime(headers),
+        'body_sha': body_sha
+    }
 
-        r = requests.get(readings_url, params=params, timeout=60)
-        if r.status_code == 200:
-            items = r.json().get('items', [])
-            return [{'timestamp': item['dateTime'], 'value': item['value']} for item in items]
-        return []
+def conditional_get(url, params=None, timeout=30):
+    '''
+    GET a JSON resource, revalidating against the copy cached by the previous run.
+    Returns (status_code, parsed body). A cached copy that is still fresh per its
+    Cache-Control max-age is returned without a request at all, and a 304 is reported
+    as a 200 carrying the cached body, so callers don't need to care either way.
+    '''
+    key = requests.Request('GET', url, params=params).prepare().url
+    cached = previous_http_cache.get(key)
+    body = previous_http_bodies.get(cached.get('body_sha')) if cached else None
+    if body is None:
+        cached = None  # no body to fall back on, so don't revalidate
+
+    if cached and is_fresh(cached):
+        http_cache[key] = cached
+        http_bodies[cached['body_sha']] = body
+        return 200, body
+
+    headers = {}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    r = SESSION.get(url, params=params, headers=headers, timeout=(CONNECT_TIMEOUT, timeout))
+    if r.status_code == 304 and cached:
+        # Headers sent with a 304 replace the stored ones (those it leaves out stay as
+        # they were), so a revalidated entry with a max-age can be served fresh again
+        entry = dict(cached)
+        for field, header in (('etag', 'ETag'), ('last_modified', 'Last-Modified'), ('date', 'Date')):
+            if header in r.headers:
+                entry[field] = r.headers[header]
+        if 'Cache-Control' in r.headers:
+            entry['max_age'] = cache_lifetime(r.headers)
+        http_cache[key] = entry
+        http_bodies[cached['body_sha']] = body
+        return 200, body
+    if r.status_code != 200:
+        return r.status_code, None
+
+    body = orjson.loads(r.content)
+    entry = cache_entry(r.headers, hashlib.sha256(r.content).hexdigest())
+    if entry['etag'] or entry['last_modified'] or entry['max_age']:
+        http_cache[key] = entry
+        http_bodies[entry['body_sha']] = body
+    return 200, body
+
+def fetch_all_readings_for_period(measure_id, since_timestamp, limit=10000, revalidate=True):
+    '''
+    Fetch all readings for a measure since a given timestamp, as parallel lists (newest first),
+    or None if the request failed. With revalidate=False it's a plain GET, kept out of the
+    HTTP cache.
+    '''
+    try:
+        readings_url = READINGS_URL.format(measure_id=measure_id)
+        params = {'since': since_timestamp, '_limit': limit, '_sorted': ''}
+
+        # The since watermark only moves when a new reading lands, so a quiet interval
+        # revalidates the same URL as last run and comes back 304
+        if revalidate:
+            status, data = conditional_get(readings_url, params=params, timeout=60)
+        else:
+            r = SESSION.get(readings_url, params=params, timeout=(CONNECT_TIMEOUT, 60))
+            status, data = r.status_code, orjson.loads(r.content) if r.status_code == 200 else None
+        if status == 200:
+            items = data.get('items', [])
+            return {
+                'timestamps': [item['dateTime'] for item in items],
+                'values': [item['value'] for item in items]
+            }
+        print(f"Error fetching readings for {measure_id}: {status}")
+        return None
     except Exception as e:
-        print(f"Error fetching readings: {e}")
-        return []
+        print(f"Error fetching readings for {measure_id}: {e}")
+        return None
+
+def iso_z(dt):
+    '''Format a UTC datetime the way the EA API does, e.g. 2024-05-01T12:00:00Z'''
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-def update_history(measure_id, existing_history, days=14):
+def history_columns(history):
+    '''
+    Normalise a saved history to parallel {'timestamps': [...], 'values': [...]} lists
+    (newest first). Files written before the columnar layout hold a list of
+    {'timestamp', 'value'} records instead.
+    '''
+    if isinstance(history, list):
+        return {
+            'timestamps': [r['timestamp'] for r in history],
+            'values': [r['value'] for r in history]
+        }
+    return history
+
+def update_history(measure_id, existing_history, now, days=14):
     '''
     Update history by:
     1. Checking what data we already have
-    2. Fetching all data for the last 14 days from the API
+    2. Fetching only readings newer than our latest one (the full 14 days on a cold start)
     3. Merging with existing data (API data fills gaps, existing data preserved)
     4. Trimming to 14 days
+    Returns (history, fetched); fetched is False if the API request failed, in which
+    case the history is just the existing one trimmed, and its newest reading is stale.
     '''
     # Calculate 14 days ago
-    cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat().replace('+00:00', 'Z')
-
-    # Fetch all available data for the last 14 days
-    print(f"Fetching {days}-day history for {measure_id}")
-    api_readings = fetch_all_readings_for_period(measure_id, cutoff)
-    print(f"  API returned {len(api_readings)} readings")
-
-    # Create dict from existing history
-    history_dict = {r['timestamp']: r['value'] for r in existing_history}
-    existing_count = len(history_dict)
-
-    # Merge API readings (will add new timestamps, update existing)
-    for r in api_readings:
-        history_dict[r['timestamp']] = r['value']
+    cutoff = iso_z(now - timedelta(days=days))
+
+    # Resume from the newest reading we hold (history is newest first), overlapping
+    # by 30 minutes to pick up late-arriving values
+    since = cutoff
+    if existing_history['timestamps']:
+        latest = parse_iso_z(existing_history['timestamps'][0])
+        watermark = iso_z(latest - timedelta(minutes=30))
+        if watermark > cutoff:
+            since = watermark
+
+    print(f"Fetching readings for {measure_id} since {since}")
+    # 15-minute readings, with headroom in case the station reports extra values. Without
+    # a watermark, since is the cutoff, which moves every run, so the URL never recurs and
+    # the full 14-day body isn't worth keeping in the HTTP cache
+    api_readings = fetch_all_readings_for_period(measure_id, since, limit=days * 96 + 50, revalidate=since != cutoff)
+    fetched = api_readings is not None
+    if not fetched:
+        api_readings = {'timestamps': [], 'values': []}
+    api_count = len(api_readings['timestamps'])
+    print(f"  {measure_id}: API returned {api_count} readings")
+
+    timestamps = existing_history['timestamps']
+    values = existing_history['values']
+    existing_count = len(timestamps)
+    newest = timestamps[0] if timestamps else ''
+
+    # Fast path (the usual case): the API only returned readings newer than ours, plus
+    # overlap we already hold unchanged, so prepend the new ones and trim the tail
+    # instead of rebuilding the whole history
+    api_timestamps = api_readings['timestamps']
+    api_values = api_readings['values']
+    n_new = index_at_or_before(api_timestamps, newest) if newest else api_count
+
+    # A repeated timestamp among the new readings also needs the merge, which collapses it
+    new_timestamps = api_timestamps[:n_new]
+    needs_merge = any(ts == next_ts for ts, next_ts in zip(new_timestamps, new_timestamps[1:]))
+    if not needs_merge:
+        for ts, val in zip(api_timestamps[n_new:], api_values[n_new:]):
+            i = index_at_or_before(timestamps, ts)
+            if i == len(timestamps) or timestamps[i] != ts or values[i] != val:
+                needs_merge = True
+                break
 
-    # Filter to last 14 days and sort (newest first)
-    filtered = [{'timestamp': ts, 'value': val} for ts, val in history_dict.items() if ts >= cutoff]
-    filtered.sort(key=lambda x: x['timestamp'], reverse=True)
+    if not needs_merge:
+        if n_new:
+            timestamps = api_timestamps[:n_new] + timestamps
+            values = api_values[:n_new] + values
+        if timestamps and timestamps[-1] < cutoff:
+            keep = bisect_left(timestamps, True, key=lambda ts: ts < cutoff)
+            timestamps, values = timestamps[:keep], values[:keep]
+        history = {'timestamps': timestamps, 'values': values}
+    else:
+        # Both sides are already newest first, so merge them in one pass. merge() is
+        # stable, so on a shared timestamp the API reading (listed first) wins and the
+        # existing one is skipped as a duplicate
+        history = {'timestamps': [], 'values': []}
+        last_ts = None
+        for ts, val in merge(zip(api_timestamps, api_values), zip(timestamps, values), key=itemgetter(0), reverse=True):
+            if ts < cutoff:
+                break
+            if ts != last_ts:
+                history['timestamps'].append(ts)
+                history['values'].append(val)
+                last_ts = ts
 
-    print(f"  History: {existing_count} existing + {len(api_readings)} from API = {len(filtered)} total (after dedup/trim)")
+    print(f"  {measure_id} history: {existing_count} existing + {api_count} from API = {len(history['timestamps'])} total (after dedup/trim)")
 
-    return filtered
+    return history, fetched
 
-def fetch_lock_level(station_id, measurement_type):
-    '''Fetch current level from a lock - tries multiple methods to get latest data'''
-    try:
-        url = f"https://environment.data.gov.uk/flood-monitoring/id/stations/{station_id}.json"
-        response = requests.get(url, timeout=30)
+def index_at_or_before(timestamps, timestamp):
+    '''Index of the first entry at or before timestamp in a newest-first list of timestamps'''
+    # "ts <= timestamp" runs False...False, True...True along a newest-first list
+    return bisect_left(timestamps, True, key=lambda ts: ts <= timestamp)
 
-        if response.status_code != 200:
-            print(f"Error fetching {station_id}: {response.status_code}")
-            return None
+def parse_iso_z(timestamp):
+    '''Parse an API timestamp such as 2024-05-01T12:00:00Z to an aware datetime'''
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
 
-        station_data = response.json()
-        measures = station_data.get('items', {}).get('measures', [])
-
-        # Find the right measurement - prefer mASD (meters above sea datum)
-        for measure in measures:
-            measure_id = measure['@id'].split('/')[-1]
-            # Check if measurement_type matches exactly (not as substring) and has mASD
-            if (f'-{measurement_type}-' in measure_id or measure_id.endswith(f'-{measurement_type}')) and 'mASD' in measure_id:
-                print(f"Found measure: {measure_id}")
-
-                # Use latestReading from the station data if available
-                latest = measure.get('latestReading')
-                if latest and 'value' in latest and 'dateTime' in latest:
-                    print(f"Using latestReading: {latest['value']}m at {latest['dateTime']}")
-                    return {
-                        'value': latest['value'],
-                        'timestamp': latest['dateTime']
-                    }
-
-                # Fallback to fetching readings endpoint with more data points
-                print(f"No latestReading, trying readings endpoint...")
-                readings_url = f"https://environment.data.gov.uk/flood-monitoring/id/measures/{measure_id}/readings.json"
-                params = {'_limit': 100}  # Get more readings to find recent data
-
-                r = requests.get(readings_url, params=params, timeout=30)
-                if r.status_code == 200:
-                    items = r.json().get('items', [])
-                    if items:
-                        print(f"Found {len(items)} readings, using most recent: {items[0]['value']}m at {items[0]['dateTime']}")
-                        return {
-                            'value': items[0]['value'],
-                            'timestamp': items[0]['dateTime']
-                        }
-                    else:
-                        print(f"Readings endpoint returned no items")
-                else:
-                    print(f"Readings endpoint error: {r.status_code}")
-
-        print(f"No suitable measure found for {station_id} {measurement_type}")
-        return None
-    except Exception as e:
-        print(f"Error fetching {station_id}: {e}")
+def nearest_index(timestamps, timestamp, tolerance):
+    '''
+    Index of the entry closest in time to timestamp in a newest-first list of timestamps,
+    or None if nothing lies within tolerance (a timedelta)
+    '''
+    # Only the neighbours either side of the insertion point can be closest
+    i = index_at_or_before(timestamps, timestamp)
+    target = parse_iso_z(timestamp)
+    best, best_gap = None, tolerance
+    for j in (i - 1, i):
+        if 0 <= j < len(timestamps):
+            gap = abs(parse_iso_z(timestamps[j]) - target)
+            if gap <= best_gap:
+                best, best_gap = j, gap
+    return best
+
+def latest_reading(history):
+    '''The newest reading in a history as {'value', 'timestamp'}, or None if it is empty'''
+    if not history['timestamps']:
         return None
+    return {
+        'value': history['values'][0],
+        'timestamp': history['timestamps'][0]
+    }
 
-def _fetch_rainfall_total(measure_id, hours):
-    '''Fetch total rainfall from a single measure for specified hours'''
+def _fetch_rainfall_totals(measure_id, hour_windows, now):
+    '''Fetch total rainfall from a single measure for each window (in hours) with one request'''
     try:
-        since = (datetime.now(timezone.utc) - timedelta(hours=hours)).isoformat().replace('+00:00', 'Z')
-        readings_url = f"https://environment.data.gov.uk/flood-monitoring/id/measures/{measure_id}/readings.json"
-        params = {'since': since, '_limit': 5000}
-        r = requests.get(readings_url, params=params, timeout=30)
+        since = {hours: iso_z(now - timedelta(hours=hours)) for hours in hour_windows}
+        readings_url = READINGS_URL.format(measure_id=measure_id)
+        # 15-minute tipping-bucket totals, with some headroom. Sorted newest first, so if
+        # the gauge reported more often than that the oldest readings are the ones cut off
+        params = {'since': since[max(hour_windows)], '_limit': max(hour_windows) * 4 + 20, '_sorted': ''}
+        r = SESSION.get(readings_url, params=params, timeout=(CONNECT_TIMEOUT, 30))
         if r.status_code == 200:
-            items = r.json().get('items', [])
-            if items:
-                return sum(item['value'] for item in items)
-        return None
+            items = orjson.loads(r.content).get('items', [])
+            if len(items) == params['_limit']:
+                print(f"WARNING: rainfall for {measure_id} hit the {params['_limit']} reading limit, totals may be short")
+            # Windows with no readings stay None so they're left out of the average
+            totals = dict.fromkeys(hour_windows)
+            for item in items:
+                for hours in hour_windows:
+                    if item['dateTime'] >= since[hours]:
+                        totals[hours] = (totals[hours] or 0) + item['value']
+            return totals
+        return {}
     except Exception as e:
         print(f"Error fetching rainfall for {measure_id}: {e}")
-        return None
+        return {}
 
 
-def fetch_avg_rainfall(hours=24):
-    '''Fetch average rainfall across all catchment stations'''
-    totals = []
-    for measure_id in RAINFALL_STATIONS:
-        total = _fetch_rainfall_total(measure_id, hours)
-        if total is not None:
-            totals.append(total)
-    if totals:
-        return sum(totals) / len(totals)
-    return 0
+def fetch_avg_rainfall(now, hour_windows=(24, 168)):
+    '''Fetch average rainfall across all catchment stations for each window (in hours)'''
+    with ThreadPoolExecutor(max_workers=len(RAINFALL_STATIONS)) as executor:
+        station_totals = list(executor.map(lambda measure_id: _fetch_rainfall_totals(measure_id, hour_windows, now), RAINFALL_STATIONS))
+    averages = {}
+    for hours in hour_windows:
+        totals = [t[hours] for t in station_totals if t.get(hours) is not None]
+        averages[hours] = sum(totals) / len(totals) if totals else 0
+    return averages
 
 def fetch_ourcs_flag(reach):
     '''Fetch OURCS flag status for a given reach (godstow or isis)'''
     try:
-        url = f"https://ourcs.co.uk/api/flags/status/{reach}/"
-        response = requests.get(url, timeout=30)
+        url = OURCS_FLAG_URL.format(reach=reach)
+        status, data = conditional_get(url, timeout=30)
 
-        if response.status_code != 200:
-            print(f"Error fetching OURCS {reach} flag: {response.status_code}")
+        if status != 200:
+            print(f"Error fetching OURCS {reach} flag: {status}")
             return None
 
-        data = response.json()
         print(f"OURCS {reach.title()} flag: {data.get('status_text', 'Unknown')}")
         return data
     except Exception as e:
         print(f"Error fetching OURCS {reach} flag: {e}")
         return None
 
-def calculate_percentile(values, percentile):
-    '''Calculate percentile from a list of values'''
+def calculate_percentiles(values, percentiles):
+    '''Calculate several percentiles (linearly interpolated) from a list of values, sorting it once'''
     if not values:
-        return None
+        return [None for _ in percentiles]
     sorted_values = sorted(values)
-    index = (percentile / 100.0) * (len(sorted_values) - 1)
-    lower = int(index)
-    upper = lower + 1
-    weight = index - lower
-
-    if upper >= len(sorted_values):
-        return sorted_values[-1]
-    return sorted_values[lower] * (1 - weight) + sorted_values[upper] * weight
+    last = len(sorted_values) - 1
+
+    results = []
+    for percentile in percentiles:
+        index = (percentile / 100.0) * last
+        lower = int(index)
+        if lower >= last:
+            results.append(sorted_values[-1])
+        else:
+            weight = index - lower
+            results.append(sorted_values[lower] * (1 - weight) + sorted_values[lower + 1] * weight)
+    return results
 
 def fetch_weather_forecast():
     '''Fetch 24-hour ensemble weather forecast from Open-Meteo API for Oxford'''
     try:
-        # Oxford coordinates
-        lat, lon = 51.7520, -1.2577
-        url = "https://ensemble-api.open-meteo.com/v1/ensemble"
         params = {
-            'latitude': lat,
-            'longitude': lon,
+            'latitude': OXFORD_LAT,
+            'longitude': OXFORD_LON,
             'hourly': 'temperature_2m,precipitation,weather_code',
             'models': 'icon_seamless',  # Best model for UK/European weather
             'forecast_hours': 24,
             'timezone': 'Europe/London'
         }
 
-        response = requests.get(url, params=params, timeout=30)
-        if response.status_code != 200:
-            print(f"Ensemble API error: {response.status_code}")
+        status, data = conditional_get(ENSEMBLE_URL, params=params, timeout=30)
+        if status != 200:
+            print(f"Ensemble API error: {status}")
             return None
 
-        data = response.json()
-
         # Ensemble API returns data differently - need to handle multiple models/members
         # The response structure has hourly data with arrays for each variable
         hourly = data.get('hourly', {})
@@ -251,23 +471,20 @@ def fetch_weather_forecast():
 def fetch_ensemble_rainfall_data():
     '''Fetch ensemble rainfall data: statistics (mean/percentiles) and 3-day daily breakdown'''
     try:
-        lat, lon = 51.7520, -1.2577
-        url = "https://ensemble-api.open-meteo.com/v1/ensemble"
         params = {
-            'latitude': lat,
-            'longitude': lon,
+            'latitude': OXFORD_LAT,
+            'longitude': OXFORD_LON,
             'hourly': 'precipitation',
             'models': 'icon_seamless',  # Best model for UK/European weather - 40 members
             'forecast_hours': 72,
             'timezone': 'Europe/London'
         }
 
-        response = requests.get(url, params=params, timeout=30)
-        if response.status_code != 200:
-            print(f"Ensemble rainfall API error: {response.status_code}")
+        status, data = conditional_get(ENSEMBLE_URL, params=params, timeout=30)
+        if status != 200:
+            print(f"Ensemble rainfall API error: {status}")
             return None, None
 
-        data = response.json()
         hourly = data.get('hourly', {})
         times = hourly.get('time', [])
 
@@ -284,24 +501,16 @@ def fetch_ensemble_rainfall_data():
             return None, None
 
         # Calculate totals for each member (for statistics)
-        totals_24h = []
-        totals_72h = []
-
-        for member_key in member_keys:
-            member_data = hourly[member_key]
-            total_24h = sum(member_data[:24]) if len(member_data) >= 24 else sum(member_data)
-            totals_24h.append(total_24h)
-            total_72h = sum(member_data[:72]) if len(member_data) >= 72 else sum(member_data)
-            totals_72h.append(total_72h)
+        members = [hourly[key] for key in member_keys]
+        totals_24h = [sum(member_data[:24]) for member_data in members]
+        totals_72h = [sum(member_data[:72]) for member_data in members]
 
         # Calculate statistics across all members
-        mean_24h = statistics.mean(totals_24h)
-        p10_24h = calculate_percentile(totals_24h, 10)
-        p90_24h = calculate_percentile(totals_24h, 90)
+        mean_24h = sum(totals_24h) / len(totals_24h)
+        p10_24h, p90_24h = calculate_percentiles(totals_24h, (10, 90))
 
-        mean_72h = statistics.mean(totals_72h)
-        p10_72h = calculate_percentile(totals_72h, 10)
-        p90_72h = calculate_percentile(totals_72h, 90)
+        mean_72h = sum(totals_72h) / len(totals_72h)
+        p10_72h, p90_72h = calculate_percentiles(totals_72h, (10, 90))
 
         stats = {
             'rainfall_24h_mean': mean_24h,
@@ -316,16 +525,16 @@ def fetch_ensemble_rainfall_data():
         print(f"Ensemble 72h: {mean_72h:.1f}mm (range: {p10_72h:.1f}-{p90_72h:.1f}mm)")
 
         # Calculate daily breakdown from ensemble mean
+        # Transpose once into per-hour rows across members rather than indexing every member each hour
+        hour_rows = list(zip_longest(*members))
         daily_totals = {}
-        for i, time_str in enumerate(times):
-            if i >= 72:
-                break
+        for i, time_str in enumerate(times[:72]):
             date = time_str.split('T')[0]
             if date not in daily_totals:
                 daily_totals[date] = []
             # Average across all ensemble members for this hour
-            hour_values = [hourly[key][i] for key in member_keys if i < len(hourly[key]) and hourly[key][i] is not None]
-            daily_totals[date].append(statistics.mean(hour_values) if hour_values else 0)
+            hour_values = [v for v in hour_rows[i] if v is not None] if i < len(hour_rows) else []
+            daily_totals[date].append(sum(hour_values) / len(hour_values) if hour_values else 0)
 
         forecast = []
         for date in sorted(daily_totals.keys())[:3]:
@@ -334,7 +543,7 @@ def fetch_ensemble_rainfall_data():
 
         print(f"3-day forecast: {len(forecast)} days")
         for day in forecast:
-            print(f"  {day['date']}: {day['precipitation']:.1f}mm")
+            print(f"  3-day forecast {day['date']}: {day['precipitation']:.1f}mm")
 
         return stats, forecast
 
@@ -346,14 +555,17 @@ def fetch_ensemble_rainfall_data():
 
 def main():
     print("Fetching river data...")
+    # One reference time for the whole run, so every cutoff and stamp agrees
+    now = datetime.now(timezone.utc)
+    load_http_cache()
 
     # Load previous data to calculate flow trend AND as fallback
     previous_data = None
     previous_flow = None
     try:
         if os.path.exists('data/current.json'):
-            with open('data/current.json', 'r') as f:
-                previous_data = json.load(f)
+            with open('data/current.json', 'rb') as f:
+                previous_data = orjson.loads(f.read())
                 if previous_data.get('differential') is not None:
                     previous_flow = previous_data['differential'] - 1.63
                     print(f"Previous flow: {previous_flow}m")
@@ -363,56 +575,64 @@ def main():
     except Exception as e:
         print(f"Could not load previous data: {e}")
 
-    # Note: On the Thames, Godstow is upstream of Osney
-    # We want downstage from Godstow and stage from Osney
-    print("\n=== Fetching current data ===")
-    godstow = fetch_lock_level('1302TH', 'downstage')  # Godstow downstream side
-    osney = fetch_lock_level('1303TH', 'stage')  # Osney general level
-
-    # Use previous data as fallback if current fetch fails
-    if not godstow and previous_data and previous_data.get('godstow_lock', {}).get('level') is not None:
-        print("WARNING: Could not fetch Godstow data, using previous reading")
-        godstow = {
-            'value': previous_data['godstow_lock']['level'],
-            'timestamp': previous_data['godstow_lock']['timestamp']
-        }
+    previous_histories = {
+        key: history_columns(previous_data.get(f'{key}_history', []) if previous_data else [])
+        for key in ('godstow', 'osney', 'farmoor')
+    }
 
-    if not osney and previous_data and previous_data.get('osney_lock', {}).get('level') is not None:
-        print("WARNING: Could not fetch Osney data, using previous reading")
-        osney = {
-            'value': previous_data['osney_lock']['level'],
-            'timestamp': previous_data['osney_lock']['timestamp']
+    # None of the endpoints depend on each other, so fetch them all concurrently
+    print("\n=== Fetching current data and 14-day history ===")
+    with ThreadPoolExecutor(max_workers=12) as executor:
+        rainfall_future = executor.submit(fetch_avg_rainfall, now, (24, 168))  # 24 hours and 7 days
+        weather_future = executor.submit(fetch_weather_forecast)
+        ensemble_future = executor.submit(fetch_ensemble_rainfall_data)
+        ourcs_godstow_future = executor.submit(fetch_ourcs_flag, 'godstow')
+        ourcs_isis_future = executor.submit(fetch_ourcs_flag, 'isis')
+        history_futures = {
+            key: executor.submit(update_history, MEASURE_IDS[key], previous_histories[key], now)
+            for key in ('godstow', 'osney', 'farmoor')
         }
 
-    avg_rainfall_24h = fetch_avg_rainfall(24)
-    avg_rainfall_7d = fetch_avg_rainfall(168)  # 7 days = 168 hours
-    weather_forecast = fetch_weather_forecast()
-    ensemble_stats, rainfall_forecast_3d = fetch_ensemble_rainfall_data()
-    ourcs_godstow = fetch_ourcs_flag('godstow')
-    ourcs_isis = fetch_ourcs_flag('isis')
-
-    # Update 14-day history for each measure
-    print("\n=== Updating 14-day history ===")
-    godstow_history = update_history(
-        MEASURE_IDS['godstow'],
-        previous_data.get('godstow_history', []) if previous_data else []
-    )
-    osney_history = update_history(
-        MEASURE_IDS['osney'],
-        previous_data.get('osney_history', []) if previous_data else []
-    )
-    farmoor_history = update_history(
-        MEASURE_IDS['farmoor'],
-        previous_data.get('farmoor_history', []) if previous_data else []
-    )
+    avg_rainfall = rainfall_future.result()
+    avg_rainfall_24h = avg_rainfall[24]
+    avg_rainfall_7d = avg_rainfall[168]
+    weather_forecast = weather_future.result()
+    ensemble_stats, rainfall_forecast_3d = ensemble_future.result()
+    ourcs_godstow = ourcs_godstow_future.result()
+    ourcs_isis = ourcs_isis_future.result()
+    godstow_history, godstow_fetched = history_futures['godstow'].result()
+    osney_history, osney_fetched = history_futures['osney'].result()
+    farmoor_history, _ = history_futures['farmoor'].result()
+
+    # Note: On the Thames, Godstow is upstream of Osney
+    # We want downstage from Godstow and stage from Osney
+    # The current levels are just the newest readings in each history
+    godstow = latest_reading(godstow_history)
+    osney = latest_reading(osney_history)
+
+    # Use previous data as fallback if current fetch fails. A failed fetch leaves the
+    # history as it was, so its newest reading is the previous one, not a fresh one
+    if not godstow_fetched or not godstow:
+        if not godstow and previous_data and (previous_data.get('godstow_lock') or {}).get('level') is not None:
+            godstow = {
+                'value': previous_data['godstow_lock']['level'],
+                'timestamp': previous_data['godstow_lock']['timestamp']
+            }
+        if godstow:
+            print("WARNING: Could not fetch Godstow data, using previous reading")
+
+    if not osney_fetched or not osney:
+        if not osney and previous_data and (previous_data.get('osney_lock') or {}).get('level') is not None:
+            osney = {
+                'value': previous_data['osney_lock']['level'],
+                'timestamp': previous_data['osney_lock']['timestamp']
+            }
+        if osney:
+            print("WARNING: Could not fetch Osney data, using previous reading")
 
     # Get current Farmoor flow from history (most recent reading)
-    farmoor_current = None
-    if farmoor_history:
-        farmoor_current = {
-            'value': farmoor_history[0]['value'],
-            'timestamp': farmoor_history[0]['timestamp']
-        }
+    farmoor_current = latest_reading(farmoor_history)
+    if farmoor_current:
         print(f"Farmoor flow: {farmoor_current['value']} m³/s")
 
     differential = None
@@ -420,35 +640,49 @@ def main():
     flow_trend = None
     flow_2h_ago = None
 
-    if osney and godstow:
+    # Same lock readings and histories as last run: the flow calculation can't change
+    previous_godstow = (previous_data.get('godstow_lock') or {}) if previous_data else {}
+    previous_osney = (previous_data.get('osney_lock') or {}) if previous_data else {}
+    inputs_unchanged = (
+        osney is not None and godstow is not None
+        and godstow == {'value': previous_godstow.get('level'), 'timestamp': previous_godstow.get('timestamp')}
+        and osney == {'value': previous_osney.get('level'), 'timestamp': previous_osney.get('timestamp')}
+        and godstow_history == previous_histories['godstow']
+        and osney_history == previous_histories['osney']
+    )
+
+    if inputs_unchanged:
+        differential = previous_data.get('differential')
+        current_flow = previous_data.get('flow')
+        flow_2h_ago = previous_data.get('flow_2h_ago')
+        flow_trend = previous_data.get('flow_trend')
+        print("No new lock readings since last run, reusing previous flow calculation")
+    elif osney and godstow:
         differential = godstow['value'] - osney['value']  # upstream - downstream
         current_flow = differential - 1.63
 
         # Calculate trend by comparing to flow from ~2 hours ago
         # Use history data to find reading closest to 2 hours ago
-        two_hours_ago = (datetime.now(timezone.utc) - timedelta(hours=2)).isoformat().replace('+00:00', 'Z')
-
-        # Create map of osney values by timestamp for flow calculation
-        osney_map = {r['timestamp']: r['value'] for r in osney_history}
-
-        # Find godstow reading closest to 2 hours ago and calculate its flow
-        for reading in godstow_history:
-            if reading['timestamp'] <= two_hours_ago:
-                osney_val = osney_map.get(reading['timestamp'])
-                if osney_val is not None:
-                    flow_2h_ago = (reading['value'] - osney_val) - 1.63
-                    print(f"Flow 2h ago ({reading['timestamp']}): {flow_2h_ago:.3f}m")
-                    break
+        two_hours_ago = iso_z(now - timedelta(hours=2))
+
+        # Find godstow reading closest to 2 hours ago with a matching osney reading
+        # and calculate its flow. The stations report every 15 minutes but aren't
+        # guaranteed to be aligned, so pair with the nearest osney reading within
+        # half an interval rather than requiring the exact same timestamp
+        godstow_ts = godstow_history['timestamps']
+        osney_ts = osney_history['timestamps']
+        for i in range(index_at_or_before(godstow_ts, two_hours_ago), len(godstow_ts)):
+            j = nearest_index(osney_ts, godstow_ts[i], timedelta(minutes=7, seconds=30))
+            if j is not None:
+                flow_2h_ago = (godstow_history['values'][i] - osney_history['values'][j]) - 1.63
+                print(f"Flow 2h ago ({godstow_ts[i]}): {flow_2h_ago:.3f}m")
+                break
 
         # Calculate trend with 0.1 threshold
         if flow_2h_ago is not None:
             flow_change = current_flow - flow_2h_ago
-            if flow_change > 0.1:
-                flow_trend = 'Rising'
-            elif flow_change < -0.1:
-                flow_trend = 'Falling'
-            else:
-                flow_trend = 'Stable'
+            # (above) - (below) is +1, 0 or -1, which indexes Falling/Stable/Rising
+            flow_trend = FLOW_TRENDS[(flow_change > 0.1) - (flow_change < -0.1) + 1]
             print(f"Flow change over 2h: {flow_change:+.3f}m -> {flow_trend}")
         else:
             flow_trend = 'Stable'
@@ -457,7 +691,7 @@ def main():
         print("ERROR: Unable to calculate flow - missing lock data even after fallback attempt")
 
     data = {
-        'last_updated': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'),
+        'last_updated': iso_z(now),
         'osney_lock': {
             'level': osney['value'] if osney else None,
             'timestamp': osney['timestamp'] if osney else None
@@ -491,11 +725,16 @@ def main():
         'farmoor_history': farmoor_history
     }
 
-    os.makedirs('data', exist_ok=True)
-    with open('data/current.json', 'w') as f:
-        json.dump(data, f, indent=2)
+    # Skip the rewrite (and the data commit it triggers) if only the run time differs
+    if previous_data and {k: v for k, v in previous_data.items() if k != 'last_updated'} == {k: v for k, v in data.items() if k != 'last_updated'}:
+        print("\n=== No changes since last run, data not rewritten ===")
+    else:
+        os.makedirs('data', exist_ok=True)
+        write_atomic('data/current.json', orjson.dumps(data))
+        print("\n=== Data saved! ===")
+    # Not committed (see HTTP_CACHE_FILE), so it's kept up to date whether or not the data changed
+    save_http_cache()
 
-    print("\n=== Data saved! ===")
     print(f"Osney: {osney['value'] if osney else 'N/A'}m")
     print(f"Godstow: {godstow['value'] if godstow else 'N/A'}m")
     print(f"Farmoor: {farmoor_current['value'] if farmoor_current else 'N/A'} m³/s")
@@ -505,7 +744,7 @@ def main():
     print(f"Avg rainfall 24h: {avg_rainfall_24h if avg_rainfall_24h else 'N/A'}mm")
     print(f"Avg rainfall 7d: {avg_rainfall_7d if avg_rainfall_7d else 'N/A'}mm")
     print(f"Weather forecast: {len(weather_forecast) if weather_forecast else 0} hours")
-    print(f"History: Godstow={len(godstow_history)}, Osney={len(osney_history)}, Farmoor={len(farmoor_history)} readings")
+    print(f"History: Godstow={len(godstow_history['timestamps'])}, Osney={len(osney_history['timestamps'])}, Farmoor={len(farmoor_history['timestamps'])} readings")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
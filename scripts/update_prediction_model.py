@@ -7,85 +7,172 @@ Update the prediction model by:
 """
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import csv
-from io import StringIO
+import hashlib
+import re
 from datetime import datetime, timedelta, timezone
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 
 # Measure IDs
 MEASURE_URLS = {
     'godstow': 'http://environment.data.gov.uk/flood-monitoring/id/measures/1302TH-level-downstage-i-15_min-mASD',
     'osney': 'http://environment.data.gov.uk/flood-monitoring/id/measures/1303TH-level-stage-i-15_min-mASD',
 }
+# Archive rows name the measure by URL; look the key up directly rather than scanning MEASURE_URLS per row
+MEASURE_KEYS = {measure_url: key for key, measure_url in MEASURE_URLS.items()}
+# The 'THH:MM' part of timestamps at 2-hour intervals (00:00, 02:00, ..., 22:00)
+TWO_HOURLY_TIMES = frozenset(f"T{hour:02d}:00" for hour in range(0, 24, 2))
+# Matches any archive line mentioning one of our measures, to skip the rest before CSV parsing
+MEASURE_LINE = re.compile('|'.join(re.escape(measure_url) for measure_url in MEASURE_URLS.values()))
 
 ARCHIVE_URL = "https://environment.data.gov.uk/flood-monitoring/archive/readings-{date}.csv"
 HISTORIC_FILE = 'data/historic.json'
 MODEL_FILE = 'data/prediction_model.json'
 
+# Part of the model's input hash: bump it whenever the calculation or the model format
+# changes, so the next run rebuilds the model even if the readings haven't changed
+MODEL_VERSION = 1
 
-def fetch_archive_day(date_str):
-    """Fetch a single day's archive CSV and extract our measures (2-hour resolution)."""
+# An archive day is only treated as final once it is this many days old; newer files
+# may have been published incomplete, so they are refetched until then
+SETTLED_DAYS = 2
+
+# Archive days are independent downloads that spend most of their time waiting on the
+# network, so fetch up to this many at once
+FETCH_WORKERS = 16
+
+# Pooled keep-alive session shared by the archive fetch workers, sized to match them.
+# The daily archive CSVs are large, so ask for them compressed and retry transient failures
+# (a read timeout only once: those downloads are slow enough already).
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=FETCH_WORKERS,
+    max_retries=Retry(total=3, read=1, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+))
+
+# Seconds to wait for a connection, separate from the long read timeout for the CSVs
+CONNECT_TIMEOUT = 10
+SESSION.headers['Accept-Encoding'] = 'gzip, deflate'
+
+
+def write_atomic(path, content):
+    """Write bytes to path via a temporary file, so a crash mid-write never leaves it truncated."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def fetch_archive_day(date_str, etag=None):
+    """Fetch a single day's archive CSV and extract our measures (2-hour resolution).
+
+    Returns (readings, etag): readings holds a timestamp -> value dict per measure,
+    ready to merge, and etag is the response's ETag. Both are None if the fetch failed.
+
+    Pass the ETag from a previous fetch of the same day to make the request conditional;
+    if the file hasn't changed the readings come back empty, as they're already stored.
+    """
     url = ARCHIVE_URL.format(date=date_str)
+    headers = {'If-None-Match': etag} if etag else {}
 
     try:
-        response = requests.get(url, timeout=120)
-        if response.status_code == 200:
-            readings = {'godstow': [], 'osney': []}
-
-            reader = csv.DictReader(StringIO(response.text))
-            for row in reader:
-                measure = row.get('measure', '')
-                timestamp = row.get('dateTime', '')
-
-                # Only keep readings at 2-hour intervals (00:00, 02:00, 04:00, etc.)
-                if 'T' in timestamp:
-                    time_part = timestamp.split('T')[1][:5]  # HH:MM
-                    hour = int(time_part[:2])
-                    minute = int(time_part[3:5])
-                    if hour % 2 != 0 or minute != 0:
+        # Streamed: the day's file is tens of MB, so parse it line by line as it arrives
+        # rather than holding the whole body (and a copy as one str) in memory
+        with SESSION.get(url, headers=headers, timeout=(CONNECT_TIMEOUT, 120), stream=True) as response:
+            if response.status_code == 304:
+                return {'godstow': {}, 'osney': {}}, etag
+            if response.status_code == 200:
+                readings = {'godstow': {}, 'osney': {}}
+
+                # Plain rows plus column positions from the header: the file has a row for
+                # every station in England, so building a dict per row dominates otherwise
+                if response.encoding is None:
+                    response.encoding = 'utf-8'  # iter_lines only decodes with a known encoding
+                lines = response.iter_lines(chunk_size=65536, decode_unicode=True)
+                header = next(csv.reader([next(lines, '')]), [])
+                measure_col = header.index('measure')
+                timestamp_col = header.index('dateTime')
+                value_col = header.index('value')
+                n_cols = len(header)
+
+                # Only a couple of hundred of the day's lines are ours: reject the rest with a
+                # single regex search on the raw line, before the csv module parses anything
+                for row in csv.reader(filter(MEASURE_LINE.search, lines)):
+                    if len(row) < n_cols:
+                        continue  # blank or truncated line
+                    measure = row[measure_col]
+                    timestamp = row[timestamp_col]
+
+                    # Only keep readings at 2-hour intervals (00:00, 02:00, 04:00, etc.)
+                    t = timestamp.find('T')
+                    if t != -1 and timestamp[t:t + 6] not in TWO_HOURLY_TIMES:
                         continue
 
-                for key, measure_url in MEASURE_URLS.items():
-                    if measure == measure_url:
-                        try:
-                            val_str = row.get('value', '')
-                            if '|' in val_str:
-                                continue
-                            readings[key].append({
-                                'timestamp': timestamp,
-                                'value': float(val_str)
-                            })
-                        except (ValueError, KeyError):
-                            pass
-
-            return readings
-        return None
+                    key = MEASURE_KEYS.get(measure)
+                    if key is None:
+                        continue
+                    # Multi-value cells ('1.234|1.235') and blanks fail float() and are skipped
+                    try:
+                        readings[key][timestamp] = float(row[value_col])
+                    except ValueError:
+                        pass
+
+                return readings, response.headers.get('ETag')
+            return None, None
     except Exception as e:
         print(f"    Error fetching {date_str}: {e}")
-        return None
+        return None, None
+
+
+def readings_by_timestamp(history):
+    """Map timestamp -> value for a saved history.
+
+    Histories are stored as parallel {'timestamps': [...], 'values': [...]} lists;
+    files written before that hold a list of {'timestamp', 'value'} records.
+    """
+    if isinstance(history, dict):
+        return dict(zip(history['timestamps'], history['values']))
+    return {r['timestamp']: r['value'] for r in history}
 
 
 def load_existing_data():
     """Load existing historic data if available."""
     if os.path.exists(HISTORIC_FILE):
         try:
-            with open(HISTORIC_FILE, 'r') as f:
-                data = json.load(f)
+            with open(HISTORIC_FILE, 'rb') as f:
+                data = orjson.loads(f.read())
             return {
-                'godstow': {r['timestamp']: r['value'] for r in data.get('godstow_history', [])},
-                'osney': {r['timestamp']: r['value'] for r in data.get('osney_history', [])},
+                'godstow': readings_by_timestamp(data.get('godstow_history', [])),
+                'osney': readings_by_timestamp(data.get('osney_history', [])),
+                'archive_days': set(data.get('metadata', {}).get('archive_days', [])),
+                'archive_etags': data.get('metadata', {}).get('archive_etags', {}),
             }
         except:
             pass
-    return {'godstow': {}, 'osney': {}}
+    return {'godstow': {}, 'osney': {}, 'archive_days': set(), 'archive_etags': {}}
 
 
-def fetch_historic_data(days_to_fetch=14, max_age_days=365):
+def load_model_input_hash():
+    """Hash of the readings the existing model was built from, if there is one."""
+    try:
+        with open(MODEL_FILE, 'rb') as f:
+            return orjson.loads(f.read()).get('input_hash')
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+
+def fetch_historic_data(days_to_fetch=14, max_age_days=365, now=None):
     """
     Incremental update: load existing data, fetch recent days, trim to max age.
     """
+    if now is None:
+        now = datetime.now(timezone.utc)
+
     # Load existing data
     print(f"  Loading existing data from {HISTORIC_FILE}...")
     all_readings = load_existing_data()
@@ -93,7 +180,7 @@ def fetch_historic_data(days_to_fetch=14, max_age_days=365):
     print(f"  Found {existing_count:,} existing Godstow readings")
 
     # Fetch recent days
-    end_date = datetime.now(timezone.utc) - timedelta(days=1)
+    end_date = now - timedelta(days=1)
     start_date = end_date - timedelta(days=days_to_fetch)
 
     dates = []
@@ -102,31 +189,51 @@ def fetch_historic_data(days_to_fetch=14, max_age_days=365):
         dates.append(current_date.strftime('%Y-%m-%d'))
         current_date += timedelta(days=1)
 
-    print(f"  Fetching last {len(dates)} days...")
+    # A settled day's archive file doesn't change, so days already merged by a previous
+    # run are skipped. Only settled days are recorded as merged: a recent day may have
+    # been published incomplete, so it is refetched (conditionally, if we have its ETag)
+    # on every run until it settles.
+    archive_days = all_readings['archive_days']
+    archive_etags = all_readings['archive_etags']
+    settled = (now - timedelta(days=SETTLED_DAYS)).strftime('%Y-%m-%d')
+    dates_to_fetch = [date for date in dates if date not in archive_days]
+    print(f"  Fetching last {len(dates)} days ({len(dates) - len(dates_to_fetch)} already stored)...")
 
     # Fetch in parallel
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {executor.submit(fetch_archive_day, date): date for date in dates}
+    with ThreadPoolExecutor(max_workers=max(1, min(FETCH_WORKERS, len(dates_to_fetch)))) as executor:
+        etags = [archive_etags.get(date) for date in dates_to_fetch]
+        results = executor.map(fetch_archive_day, dates_to_fetch, etags)
 
-        for future in as_completed(futures):
-            readings = future.result()
+        for date, (readings, etag) in zip(dates_to_fetch, results):
             if readings:
+                # Settled days are never requested again, so their ETags aren't needed
+                if date <= settled:
+                    archive_days.add(date)
+                    archive_etags.pop(date, None)
+                elif etag:
+                    archive_etags[date] = etag
                 for key in ['godstow', 'osney']:
-                    for r in readings[key]:
-                        all_readings[key][r['timestamp']] = r['value']
+                    all_readings[key].update(readings[key])
 
     # Trim to max age
-    cutoff = (datetime.now(timezone.utc) - timedelta(days=max_age_days)).isoformat().replace('+00:00', 'Z')
+    cutoff = (now - timedelta(days=max_age_days)).isoformat().replace('+00:00', 'Z')
 
+    # Stored as parallel timestamp/value lists (oldest first) rather than a record per reading
     result = {}
+    # Drop expired readings before sorting, and sort the bare timestamp strings
     for key in ['godstow', 'osney']:
-        result[key] = [
-            {'timestamp': ts, 'value': val}
-            for ts, val in sorted(all_readings[key].items())
-            if ts >= cutoff
-        ]
-
-    print(f"  After update: {len(result['godstow']):,} Godstow, {len(result['osney']):,} Osney readings")
+        readings = all_readings[key]
+        timestamps = sorted(ts for ts in readings if ts >= cutoff)
+        result[key] = {
+            'timestamps': timestamps,
+            'values': [readings[ts] for ts in timestamps],
+        }
+
+    result['archive_days'] = sorted(date for date in archive_days if date >= cutoff[:10])
+    # Only unsettled days in this run's window are ever revalidated
+    result['archive_etags'] = {date: archive_etags[date] for date in dates if date in archive_etags and date not in archive_days}
+
+    print(f"  After update: {len(result['godstow']['timestamps']):,} Godstow, {len(result['osney']['timestamps']):,} Osney readings")
     return result
 
 
@@ -140,34 +247,40 @@ def calculate_differential_decay_rate(data):
     Returns a single median drop rate.
     """
     # Build differential at each timestamp
-    godstow = {r['timestamp']: r['value'] for r in data['godstow_history']}
-    osney = {r['timestamp']: r['value'] for r in data['osney_history']}
+    godstow = readings_by_timestamp(data['godstow_history'])
+    osney = readings_by_timestamp(data['osney_history'])
 
-    differentials = {}
-    for ts in godstow:
-        if ts in osney:
-            differentials[ts] = (godstow[ts] - osney[ts]) - 1.63
+    # Timestamps present at both locks, intersected in one C-level pass
+    differentials = {
+        ts: (godstow[ts] - osney[ts]) - 1.63
+        for ts in godstow.keys() & osney.keys()
+    }
 
     print(f"   {len(differentials):,} paired differential readings")
 
-    # Build a lookup by datetime for finding 24h-apart pairs
-    dt_lookup = {}
-    for ts, diff in differentials.items():
-        try:
-            dt = datetime.fromisoformat(ts.replace('Z', '+00:00'))
-            dt_lookup[dt] = diff
-        except (ValueError, AttributeError):
-            continue
+    # Timestamps share one fixed ISO format, so the reading 24h later has the
+    # same string with the date part advanced a day. Only ~365 distinct dates
+    # occur, so each next-day string is computed once and cached.
+    next_day = {}
+    for ts in differentials:
+        day = ts[:10]
+        if day not in next_day:
+            try:
+                next_day[day] = (datetime.fromisoformat(day) + timedelta(days=1)).strftime('%Y-%m-%d')
+            except ValueError:
+                next_day[day] = None
 
     # For each reading above green threshold, find the reading exactly 24h later
     GREEN_THRESHOLD = 0.45
     drops = []
-    for dt, diff_start in dt_lookup.items():
+    for ts, diff_start in differentials.items():
         if diff_start < GREEN_THRESHOLD:
             continue  # below green — no-one cares about decay here
-        dt_next = dt + timedelta(hours=24)
-        if dt_next in dt_lookup:
-            diff_end = dt_lookup[dt_next]
+        next_date = next_day[ts[:10]]
+        if next_date is None:
+            continue
+        diff_end = differentials.get(next_date + ts[10:])
+        if diff_end is not None:
             drop = diff_start - diff_end  # positive = falling
 
             # Only count days where differential actually fell
@@ -193,65 +306,75 @@ def main():
     print("="*60)
     print(f"Started: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
+    # One clock reading for the whole run: archive window, cutoff and file stamps
+    now = datetime.now(timezone.utc)
+    now_iso = now.isoformat().replace('+00:00', 'Z')
+
     # Fetch historic data
     print("\n1. Fetching historic data from EA archive...")
-    raw_data = fetch_historic_data(days_to_fetch=14, max_age_days=365)
+    raw_data = fetch_historic_data(days_to_fetch=14, max_age_days=365, now=now)
 
     # Save historic data
     os.makedirs('data', exist_ok=True)
 
-    all_timestamps = (
-        [r['timestamp'] for r in raw_data['godstow']] +
-        [r['timestamp'] for r in raw_data['osney']]
-    )
+    all_timestamps = raw_data['godstow']['timestamps'] + raw_data['osney']['timestamps']
 
     historic = {
         'metadata': {
-            'created': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'),
+            'created': now_iso,
             'earliest_reading': min(all_timestamps) if all_timestamps else None,
             'latest_reading': max(all_timestamps) if all_timestamps else None,
             'reading_counts': {
-                'godstow': len(raw_data['godstow']),
-                'osney': len(raw_data['osney']),
-            }
+                'godstow': len(raw_data['godstow']['timestamps']),
+                'osney': len(raw_data['osney']['timestamps']),
+            },
+            'archive_days': raw_data['archive_days'],
+            'archive_etags': raw_data['archive_etags'],
         },
         'godstow_history': raw_data['godstow'],
         'osney_history': raw_data['osney'],
     }
 
-    with open(HISTORIC_FILE, 'w') as f:
-        json.dump(historic, f, indent=2)
+    # A year of readings: written compact, nobody reads this file by eye
+    write_atomic(HISTORIC_FILE, orjson.dumps(historic))
 
     print(f"   Saved {HISTORIC_FILE}")
-    print(f"   Godstow: {len(raw_data['godstow']):,} readings")
-    print(f"   Osney: {len(raw_data['osney']):,} readings")
-
-    # Calculate differential decay rate
-    print("\n2. Calculating differential decay rate...")
-    decay_rate = calculate_differential_decay_rate(historic)
-    print(f"   Avg: {decay_rate['avg_drop_mm_per_day']:.0f} mm/day, "
-          f"Median: {decay_rate['median_drop_mm_per_day']:.0f} mm/day "
-          f"({decay_rate['n_pairs']} pairs)")
-
-    # Build model JSON
-    model = {
-        'updated': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'),
-        'data_range': {
-            'start': historic['metadata']['earliest_reading'],
-            'end': historic['metadata']['latest_reading'],
-            'samples': decay_rate['n_pairs']
-        },
-        'thresholds': {
-            'green_amber_flow': 0.45,
-            'amber_red_flow': 0.75
-        },
-        'differential_decay_rate': decay_rate,
-    }
-
-    with open(MODEL_FILE, 'w') as f:
-        json.dump(model, f, indent=2)
-
-    print(f"\n3. Saved model to {MODEL_FILE}")
+    print(f"   Godstow: {len(raw_data['godstow']['timestamps']):,} readings")
+    print(f"   Osney: {len(raw_data['osney']['timestamps']):,} readings")
+
+    # The model is a pure function of the readings and the calculation: if neither has
+    # changed since the model was last built (e.g. a rerun with no new archive days),
+    # keep it as is
+    input_hash = hashlib.sha256(orjson.dumps([MODEL_VERSION, raw_data['godstow'], raw_data['osney']])).hexdigest()
+    if load_model_input_hash() == input_hash:
+        print(f"\n2. Readings unchanged since {MODEL_FILE} was built, skipping recalculation")
+    else:
+        # Calculate differential decay rate
+        print("\n2. Calculating differential decay rate...")
+        decay_rate = calculate_differential_decay_rate(historic)
+        print(f"   Avg: {decay_rate['avg_drop_mm_per_day']:.0f} mm/day, "
+              f"Median: {decay_rate['median_drop_mm_per_day']:.0f} mm/day "
+              f"({decay_rate['n_pairs']} pairs)")
+
+        # Build model JSON
+        model = {
+            'updated': now_iso,
+            'data_range': {
+                'start': historic['metadata']['earliest_reading'],
+                'end': historic['metadata']['latest_reading'],
+                'samples': decay_rate['n_pairs']
+            },
+            'thresholds': {
+                'green_amber_flow': 0.45,
+                'amber_red_flow': 0.75
+            },
+            'differential_decay_rate': decay_rate,
+            'input_hash': input_hash,
+        }
+
+        write_atomic(MODEL_FILE, orjson.dumps(model, option=orjson.OPT_INDENT_2))
+
+        print(f"\n3. Saved model to {MODEL_FILE}")
 
     print("\n" + "="*60)
     print("Model Update Complete")